@@ -4,12 +4,17 @@ import asyncio
 from getopt import getopt
 from inspect import isclass
 from sys import argv
-from typing import Optional, Union
-
-from bleak import BleakScanner, BleakClient
+from typing import List, Optional, Tuple, Union
 
 from .opsv1 import *
 from .opsv2 import *
+from .adapters import AdapterPool
+from .archive import Archive, Redecode
+from .export import Exporter, exporter
+from .records import Record
+from .session import Session
+from .store import DEFAULT_STORE, Query, Store
+from .sync import Sync
 
 OPS = {
     cls.__name__.lower(): cls
@@ -21,17 +26,13 @@ OPS = {
     and not name.startswith("_")
 }
 
+# Commands that are served locally, without connecting to the ring
+LOCAL = {"query": Query, "redecode": Redecode}
+
 Op = Union[Opv1, Opv2]
 
 verbose = False
 
-# This is a "fake" service: the device does not support it, and it does
-# not show up after connect and service discovery. But it is included in
-# the advertisements, so we will use it to detect the peripheral that we
-# want.
-ADV_SRV_UUID = "00003802-0000-1000-8000-00805f9b34fb"
-# DEV_INFO_UUID = "0000180a-0000-1000-8000-00805f9b34fb"
-
 
 def show(bstr):
     try:
@@ -40,33 +41,22 @@ def show(bstr):
         return bstr.hex()
 
 
-async def main(addr: Optional[str], op: Op):
-    fdev = None
-    async with BleakScanner() as scanner:
-        async for dev, data in scanner.advertisement_data():
-            print(
-                "address",
-                dev.address,
-                "name",
-                dev.name,
-                "rssi",
-                data.rssi,
-                end="\033[K\r",
-            )
-            if (
-                (addr is not None and dev.address == addr)
-                or (addr is None and data.service_uuids
-                and ADV_SRV_UUID in data.service_uuids)
-            ):
-                fdev = dev
-                print("Found", fdev, end="\033[K\n")
-                break
-    async with BleakClient(fdev) as client:
-        srvd = {srv.uuid: srv for srv in client.services}
+async def main(
+    addr: Optional[str],
+    op: Op,
+    store: Store,
+    pool: AdapterPool,
+    exp: Optional[Exporter],
+):
+    found = await pool.scan(None if addr is None else [addr])
+    if not found:
+        return
+    fdev = found[0]
+    async with pool.connect(fdev) as client:
         if verbose:
             print("Services:")
-            for k, s in srvd.items():
-                print(k)
+            for s in client.services:
+                print(s.uuid)
                 for char in s.characteristics:
                     print(f"\t{char.uuid}: {char.description}: ")
                     print(f"\t{char.properties}: ")
@@ -78,21 +68,46 @@ async def main(addr: Optional[str], op: Op):
                         print(
                             f"\t\tWWR max size {char.max_write_without_response_size}"
                         )
-        if op.UART_SRV_UUID not in srvd:
-            print("Service", op.UART_SRV_UUID, "not found")
-            return
-        if {op.UART_WRT_UUID, op.UART_NOT_UUID} != {
-            c.uuid for c in srvd[op.UART_SRV_UUID].characteristics
-        }:
-            print("Characteristics not found")
-            return
-        await client.start_notify(op.UART_NOT_UUID, op.recv)
-        await client.write_gatt_char(
-            op.UART_WRT_UUID, op.send(), response=False
-        )
-        await op.done.wait()
+        session = Session(client, Archive(store))
+        loop = asyncio.get_running_loop()
+        # Decode the result of every op while the next one is running
+        decoding = None
+        for sub in op.split():
+            if await session.run(sub) is None:
+                break
+            if decoding is not None:
+                report(fdev.address, *await decoding, store, exp)
+            decoding = loop.run_in_executor(
+                None, decode, sub, session.transfer
+            )
         await client.disconnect()
-    print(op.result())
+    if decoding is not None:
+        report(fdev.address, *await decoding, store, exp)
+
+
+def decode(
+    op: Op, transfer: Optional[int]
+) -> Tuple[Op, Optional[int], str, List[Record]]:
+    if not hasattr(op, "records"):
+        return op, transfer, op.result(), []
+    recs = list(op.records())
+    return op, transfer, op.text(recs), recs
+
+
+def report(
+    device: str,
+    op: Op,
+    transfer: Optional[int],
+    text: str,
+    recs: List[Record],
+    store: Store,
+    exp: Optional[Exporter],
+) -> None:
+    if hasattr(op, "records"):
+        store.add(device, op.METRIC, recs, transfer)
+        if exp is not None:
+            exp.add(device, op, recs)
+    print(text)
 
 
 async def shutdown():
@@ -100,21 +115,59 @@ async def shutdown():
 
 
 if __name__ == "__main__":
-    topts, args = getopt(argv[1:], "hva:")
+    topts, args = getopt(argv[1:], "hva:e:i:s:")
     opts = dict(topts)
     verbose = "-v" in opts
     opsv1_verbosity(verbose)
     opsv2_verbosity(verbose)
-    if len(args) == 0 or "-h" in opts or args[0] not in OPS:
-        print(f"Usage: {argv[0]} [-h] [-v] [-a ADDR] command [key=value ...]")
-        if len(args) > 0 and args[0] in OPS:
-            print("Command", args[0], ":", OPS[args[0]].__doc__)
+    cmds = {**OPS, **LOCAL, "sync": Sync}
+    if len(args) == 0 or "-h" in opts or args[0] not in cmds:
+        print(
+            f"Usage: {argv[0]} [-h] [-v] [-a ADDR[,ADDR...]]"
+            " [-i ADAPTER[,ADAPTER...]] [-s STORE]"
+            " [-e {influx|openmetrics|sqlite}:PATH[,batch=N][,interval=SEC]"
+            "[,backlog=N]] command [key=value ...]"
+        )
+        if len(args) > 0 and args[0] in cmds:
+            print("Command", args[0], ":", cmds[args[0]].__doc__)
         else:
-            print("Commands are:", ", ".join(OPS.keys()))
+            print("Commands are:", ", ".join(cmds.keys()))
         exit(0)
     kwargs = dict(el.split(sep="=", maxsplit=1) for el in args[1:])
-    op = OPS[args[0]](**kwargs)
+    # Local commands that can export have an exporter attribute
+    if (
+        "-e" in opts
+        and args[0] in LOCAL
+        and not hasattr(LOCAL[args[0]], "exporter")
+    ):
+        print("Command", args[0], "has nothing to export, -e is not allowed")
+        exit(1)
+    if args[0] != "sync" and "," in opts.get("-a", ""):
+        print("Only sync takes several addresses")
+        exit(1)
+    store = Store(opts.get("-s", DEFAULT_STORE))
+    exp = exporter(opts["-e"]) if "-e" in opts else None
+    if args[0] in LOCAL:
+        lop = LOCAL[args[0]](store, opts.get("-a", None), **kwargs)
+        if exp is not None:
+            lop.exporter = exp
+        for line in lop.lines():
+            print(line)
+        if exp is not None:
+            exp.close()
+        exit(0)
+    pool = AdapterPool(opts["-i"].split(",") if "-i" in opts else None)
     try:
-        asyncio.run(main(opts.get("-a", None), op))
+        if args[0] == "sync":
+            addrs = opts["-a"].split(",") if "-a" in opts else None
+            asyncio.run(Sync(store, pool, exp, **kwargs).run(addrs))
+        else:
+            op = OPS[args[0]](**kwargs)
+            asyncio.run(main(opts.get("-a", None), op, store, pool, exp))
+    except asyncio.TimeoutError:
+        print("The ring did not respond in time")
     except KeyboardInterrupt:
         asyncio.run(shutdown())
+    finally:
+        if exp is not None:
+            exp.close()
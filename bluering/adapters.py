@@ -0,0 +1,222 @@
+from asyncio import (
+    Condition,
+    Event,
+    TimeoutError,
+    create_task,
+    gather,
+    wait_for,
+)
+from contextlib import asynccontextmanager
+from typing import (
+    Any,
+    AsyncIterator,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from bleak import BleakClient, BleakScanner
+from bleak.backends.device import BLEDevice
+from bleak.exc import BleakError
+
+# This is a "fake" service: the device does not support it, and it does
+# not show up after connect and service discovery. But it is included in
+# the advertisements, so we will use it to detect the peripheral that we
+# want.
+ADV_SRV_UUID = "00003802-0000-1000-8000-00805f9b34fb"
+# DEV_INFO_UUID = "0000180a-0000-1000-8000-00805f9b34fb"
+
+# How many rings to keep connected over one adapter at the same time
+MAX_CONNECTIONS = 4
+# How long to scan for the rings, in seconds, before giving up on those
+# that are not heard
+SCAN_TIMEOUT = 30.0
+# How long to keep scanning after the rings are found, in seconds, for the
+# other adapters to hear them too
+SETTLE = 3.0
+
+NO_RSSI = -1000
+
+
+class Backend:
+    """
+    Makes scanners and clients that use the given adapter
+    (None for the system default)
+    """
+
+    def scanner(self, adapter: Optional[str]) -> Any:
+        if adapter is None:
+            return BleakScanner()
+        return BleakScanner(adapter=adapter)
+
+    def client(
+        self, dev: Union[BLEDevice, str], adapter: Optional[str]
+    ) -> Any:
+        if adapter is None:
+            return BleakClient(dev)
+        return BleakClient(dev, adapter=adapter)
+
+
+class AdapterPool:
+    """
+    Spread connections to the rings over several Bluetooth adapters.
+    A ring goes to the least loaded adapter that has heard it, preferring
+    better signal, and to other adapters if connection fails.
+    """
+
+    def __init__(
+        self,
+        adapters: Optional[List[str]] = None,
+        backend: Optional[Backend] = None,
+        limit: int = MAX_CONNECTIONS,
+    ) -> None:
+        self.adapters: List[Optional[str]] = list(adapters or [None])
+        self.backend = backend or Backend()
+        self.limit = limit
+        self.load: Dict[Optional[str], int] = {a: 0 for a in self.adapters}
+        self.changed = Condition()
+        # (adapter, address) -> what that adapter got from advertisements
+        self.rssi: Dict[Tuple[Optional[str], str], int] = {}
+        self.seen: Dict[Tuple[Optional[str], str], BLEDevice] = {}
+
+    async def scan(self, addrs: Optional[List[str]]) -> List[BLEDevice]:
+        """
+        Scan on all adapters until all rings with given addresses are seen,
+        or, if no addresses are given, until the first ring is seen, but
+        no longer than SCAN_TIMEOUT seconds. Then keep scanning for up to
+        SETTLE seconds, until every adapter has heard the rings that were
+        found, to know their signal there. Return the rings found.
+        """
+        found: Dict[str, BLEDevice] = {}
+        complete = Event()
+        heard = Event()
+
+        def check() -> None:
+            if addrs is None or set(found) >= set(addrs):
+                complete.set()
+            if complete.is_set() and all(
+                (a, addr) in self.rssi for a in self.adapters for addr in found
+            ):
+                heard.set()
+
+        async def scan_one(adapter: Optional[str]) -> None:
+            async with self.backend.scanner(adapter) as scanner:
+                async for dev, data in scanner.advertisement_data():
+                    print(
+                        "address",
+                        dev.address,
+                        "name",
+                        dev.name,
+                        "rssi",
+                        data.rssi,
+                        end="\033[K\r",
+                    )
+                    if (addrs is not None and dev.address in addrs) or (
+                        addrs is None
+                        and data.service_uuids
+                        and ADV_SRV_UUID in data.service_uuids
+                    ):
+                        if complete.is_set() and dev.address not in found:
+                            continue  # Another ring, when one was asked for
+                        self.rssi[(adapter, dev.address)] = data.rssi
+                        self.seen[(adapter, dev.address)] = dev
+                        if dev.address not in found:
+                            found[dev.address] = dev
+                            print("Found", dev, end="\033[K\n")
+                        check()
+
+        tasks = [create_task(scan_one(a)) for a in self.adapters]
+        try:
+            await wait_for(complete.wait(), SCAN_TIMEOUT)
+        except TimeoutError:
+            missing = set(addrs or []) - set(found)
+            print("Not found:", ", ".join(sorted(missing)) or "any ring")
+            complete.set()  # Only the rings that were found now
+        if found:
+            try:
+                await wait_for(heard.wait(), SETTLE)
+            except TimeoutError:
+                pass
+        for task in tasks:
+            task.cancel()
+        await gather(*tasks, return_exceptions=True)
+        return list(found.values())
+
+    def candidates(self, address: str) -> List[Optional[str]]:
+        """
+        Adapters to try, in order of preference
+        """
+        return sorted(
+            self.adapters,
+            key=lambda a: (
+                self.load[a] >= self.limit,
+                (a, address) not in self.rssi,
+                self.load[a],
+                -self.rssi.get((a, address), NO_RSSI),
+            ),
+        )
+
+    async def acquire(self, address: str) -> List[Optional[str]]:
+        """
+        Wait until some adapter is not full, and take it. Return all
+        adapters in order of preference, to fail over to the rest.
+        """
+        async with self.changed:
+            await self.changed.wait_for(
+                lambda: any(n < self.limit for n in self.load.values())
+            )
+            cands = self.candidates(address)
+            self.load[cands[0]] += 1
+            return cands
+
+    async def release(self, adapter: Optional[str]) -> None:
+        async with self.changed:
+            self.load[adapter] -= 1
+            self.changed.notify_all()
+
+    @asynccontextmanager
+    async def connect(self, dev: BLEDevice) -> AsyncIterator[Any]:
+        """
+        Connected client for the ring, over the best adapter that works
+        """
+        cands = await self.acquire(dev.address)
+        adapter = cands[0]
+        tried: Set[Optional[str]] = set()
+        while True:
+            client = self.backend.client(
+                self.seen.get((adapter, dev.address), dev.address), adapter
+            )
+            try:
+                await client.connect()
+                break
+            except (BleakError, OSError, TimeoutError) as e:
+                failed = adapter
+                tried.add(failed)
+                rest = [a for a in cands if a not in tried]
+                async with self.changed:
+                    self.load[failed] -= 1
+                    self.changed.notify_all()
+                    if rest:
+                        # Fail over to the best adapter that has room
+                        await self.changed.wait_for(
+                            lambda: any(
+                                self.load[a] < self.limit for a in rest
+                            )
+                        )
+                        adapter = next(
+                            a for a in rest if self.load[a] < self.limit
+                        )
+                        self.load[adapter] += 1
+                if not rest:
+                    raise
+                print(dev.address, "failed on", failed, e, "trying", adapter)
+        try:
+            yield client
+        finally:
+            try:
+                await client.disconnect()
+            finally:
+                await self.release(adapter)
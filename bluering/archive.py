@@ -0,0 +1,402 @@
+from datetime import datetime
+from hashlib import sha256
+from itertools import groupby
+from json import dumps, loads
+from struct import pack, unpack_from
+from typing import (
+    Any,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Type,
+)
+from zlib import compress, decompress
+
+from . import opsv1, opsv2
+from .export import Exporter
+from .store import Store, timestamp
+
+# Raw notifications received for every op run are kept, in the order of
+# arrival. The bytes of a transfer are cut into pieces that are addressed
+# by the hash of their content, so that data that comes again in later
+# transfers is stored once: days of the V2 logs, which repeat the past
+# week every time with the day numbers changed, and runs of V1 frames,
+# cut where the content of the frames says, so that the same frames in
+# another transfer are cut the same way. A transfer is kept as a recipe:
+# its frame sizes, and its pieces and short literal bytes, like the day
+# numbers, in order. New pieces are kept loose, and compressed together
+# when there are PACK bytes of them.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pieces (
+    hash BLOB NOT NULL PRIMARY KEY,
+    pack INTEGER REFERENCES packs (id),
+    offset INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    data BLOB
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS pieces_loose ON pieces (pack) WHERE pack IS NULL;
+CREATE TABLE IF NOT EXISTS packs (
+    id INTEGER PRIMARY KEY,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS transfers (
+    id INTEGER PRIMARY KEY,
+    device TEXT NOT NULL,
+    op TEXT NOT NULL,
+    opcode INTEGER NOT NULL,
+    kwargs TEXT NOT NULL,
+    start REAL NOT NULL,
+    end REAL NOT NULL,
+    recipe BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transfers_start ON transfers (start);
+"""
+
+HASH = 16  # Bytes of sha256 that address a piece
+MIN_PIECE = 24  # Shorter parts of a transfer are kept in its recipe
+PACK = 65536  # Bytes of loose pieces to compress together
+RUN = 16  # Frames in a piece of a V1 transfer, on average
+
+LITERAL = 0
+PIECE = 1
+
+
+def cuts(
+    cls: Optional[Type], stream: bytes, sizes: Sequence[int]
+) -> List[Tuple[int, int]]:
+    """
+    Parts of the transfer worth keeping as pieces, as (start, end) in order
+    """
+    if cls is opsv2.SPO2Log:
+        # After the header, days of 49 bytes: days ago, then values
+        return [(pos + 1, pos + 49) for pos in range(6, len(stream) - 48, 49)]
+    if cls is opsv2.SleepLog:
+        # After the header and number of days: days ago, size, values
+        parts = []
+        pos = 7
+        while pos + 2 < len(stream):
+            end = min(pos + 2 + stream[pos + 1], len(stream))
+            parts.append((pos + 2, end))
+            pos = end
+        return parts
+    if cls is not None and issubclass(cls, opsv2.Opv2):
+        return [(6, len(stream))]
+    parts = []
+    start = end = 0
+    for size in sizes:
+        end += size
+        if stream[end - 1] % RUN == 0 or end == len(stream):
+            parts.append((start, end))
+            start = end
+    return parts
+
+
+def unpack_frames(block: bytes) -> Iterator[bytes]:
+    """
+    Frames of a transfer in the archive of the first version, where each
+    transfer was one block of frames prefixed with their sizes
+    """
+    pos = 0
+    while pos < len(block):
+        (size,) = unpack_from("<H", block, pos)
+        yield block[pos + 2 : pos + 2 + size]
+        pos += 2 + size
+
+
+def opclass(name: str) -> Optional[Type]:
+    """
+    Find op class by its name, case insensitive
+    """
+    return next(
+        (
+            cls
+            for mod in (opsv1, opsv2)
+            for cname, cls in vars(mod).items()
+            if cname.lower() == name.lower()
+        ),
+        None,
+    )
+
+
+class Archive:
+    """
+    Append-only archive of raw frames received from the rings,
+    kept in the same database as the decoded history
+    """
+
+    def __init__(self, store: Store) -> None:
+        self.db = store.db
+        if self.db.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'blocks'"
+        ).fetchone():
+            self.upgrade()
+        self.db.executescript(SCHEMA)
+        (self.loose,) = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM pieces WHERE pack IS NULL"
+        ).fetchone()
+        self.cached: Tuple[Optional[int], bytes] = (None, b"")
+
+    def upgrade(self) -> None:
+        """
+        Convert the archive of the first version, with one compressed
+        block per transfer, to pieces
+        """
+        if not self.db.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'old_transfers'"
+        ).fetchone():
+            self.db.executescript(
+                "DROP INDEX IF EXISTS transfers_start;"
+                " ALTER TABLE transfers RENAME TO old_transfers;"
+            )
+        self.db.executescript(SCHEMA)
+        with self.db:  # Left from an upgrade that was interrupted
+            self.db.execute("DELETE FROM transfers")
+        self.loose = 0
+        for dev, name, opcode, kwargs, start, end, data in self.db.execute(
+            "SELECT device, op, opcode, kwargs, start, end, data"
+            " FROM old_transfers JOIN blocks ON block = hash ORDER BY id"
+        ):
+            frames = list(unpack_frames(decompress(data)))
+            self.insert(
+                dev,
+                name,
+                opclass(name),
+                opcode,
+                kwargs,
+                b"".join(frames),
+                [len(fr) for fr in frames],
+                start,
+                end,
+            )
+        self.db.executescript("DROP TABLE old_transfers; DROP TABLE blocks;")
+
+    def add(
+        self,
+        device: str,
+        op: Any,
+        stream: bytes,
+        sizes: Sequence[int],
+        start: float,
+        end: float,
+    ) -> int:
+        """
+        Add a transfer: all frames received, back to back, and their sizes.
+        Return its id.
+        """
+        return self.insert(
+            device,
+            op.__class__.__name__,
+            op.__class__,
+            op.OPCODE,
+            dumps(op.kwargs),
+            stream,
+            sizes,
+            start,
+            end,
+        )
+
+    def insert(
+        self,
+        device: str,
+        name: str,
+        cls: Optional[Type],
+        opcode: int,
+        kwargs: str,
+        stream: bytes,
+        sizes: Sequence[int],
+        start: float,
+        end: float,
+    ) -> int:
+        runs = [(size, len(list(same))) for size, same in groupby(sizes)]
+        recipe = [pack("<H", len(runs))] + [pack("<HH", *run) for run in runs]
+        pieces = []
+        literal = b""
+        pos = 0
+        for first, last in cuts(cls, stream, sizes) + [
+            (len(stream), len(stream))
+        ]:
+            literal += stream[pos:first]
+            if last - first < MIN_PIECE:
+                literal += stream[first:last]
+            else:
+                if literal:
+                    recipe.append(pack("<BH", LITERAL, len(literal)) + literal)
+                    literal = b""
+                piece = bytes(stream[first:last])
+                digest = sha256(piece).digest()[:HASH]
+                recipe.append(pack("<B", PIECE) + digest)
+                pieces.append((digest, len(piece), piece))
+            pos = last
+        if literal:
+            recipe.append(pack("<BH", LITERAL, len(literal)) + literal)
+        with self.db:
+            for digest, size, piece in pieces:
+                if self.db.execute(
+                    "INSERT OR IGNORE INTO pieces VALUES (?, NULL, 0, ?, ?)",
+                    (digest, size, piece),
+                ).rowcount:
+                    self.loose += size
+            transfer = self.db.execute(
+                "INSERT INTO transfers"
+                " (device, op, opcode, kwargs, start, end, recipe)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (device, name, opcode, kwargs, start, end, b"".join(recipe)),
+            ).lastrowid
+        if self.loose >= PACK:
+            self.pack()
+        return transfer
+
+    def pack(self) -> None:
+        """
+        Compress loose pieces together
+        """
+        pieces = self.db.execute(
+            "SELECT hash, data FROM pieces WHERE pack IS NULL"
+        ).fetchall()
+        with self.db:
+            packid = self.db.execute(
+                "INSERT INTO packs (data) VALUES (?)",
+                (compress(b"".join(data for _, data in pieces), 9),),
+            ).lastrowid
+            offset = 0
+            for digest, data in pieces:
+                self.db.execute(
+                    "UPDATE pieces SET pack = ?, offset = ?, data = NULL"
+                    " WHERE hash = ?",
+                    (packid, offset, digest),
+                )
+                offset += len(data)
+        self.loose = 0
+
+    def piece(self, digest: bytes) -> bytes:
+        packid, offset, size, data = self.db.execute(
+            "SELECT pack, offset, size, data FROM pieces WHERE hash = ?",
+            (digest,),
+        ).fetchone()
+        if data is not None:
+            return data
+        if self.cached[0] != packid:
+            (packed,) = self.db.execute(
+                "SELECT data FROM packs WHERE id = ?", (packid,)
+            ).fetchone()
+            self.cached = (packid, decompress(packed))
+        return self.cached[1][offset : offset + size]
+
+    def frames(self, recipe: bytes) -> List[bytes]:
+        """
+        Frames of the transfer made by the recipe
+        """
+        (count,) = unpack_from("<H", recipe)
+        pos = 2
+        sizes: List[int] = []
+        for _ in range(count):
+            size, repeat = unpack_from("<HH", recipe, pos)
+            sizes.extend([size] * repeat)
+            pos += 4
+        parts = []
+        while pos < len(recipe):
+            if recipe[pos] == LITERAL:
+                (size,) = unpack_from("<H", recipe, pos + 1)
+                parts.append(recipe[pos + 3 : pos + 3 + size])
+                pos += 3 + size
+            else:
+                parts.append(self.piece(recipe[pos + 1 : pos + 1 + HASH]))
+                pos += 1 + HASH
+        stream = b"".join(parts)
+        frames = []
+        pos = 0
+        for size in sizes:
+            frames.append(stream[pos : pos + size])
+            pos += size
+        return frames
+
+    def transfers(
+        self,
+        op: Optional[str] = None,
+        device: Optional[str] = None,
+        start: Optional[int] = None,
+        end: Optional[int] = None,
+    ) -> Iterator[Tuple[int, str, str, dict, float, List[bytes]]]:
+        """
+        Yield (id, device, op, kwargs, start, frames) in the order of start
+        """
+        conds = []
+        parms: list = []
+        for cond, val in (
+            ("op = ?", op),
+            ("device = ?", device),
+            ("start >= ?", start),
+            ("start < ?", end),
+        ):
+            if val is not None:
+                conds.append(cond)
+                parms.append(val)
+        where = f" WHERE {' AND '.join(conds)}" if conds else ""
+        for tid, dev, name, kwargs, tstart, recipe in self.db.execute(
+            "SELECT id, device, op, kwargs, start, recipe FROM transfers"
+            + where
+            + " ORDER BY start",
+            parms,
+        ):
+            yield tid, dev, name, loads(kwargs), tstart, self.frames(recipe)
+
+
+class Redecode:
+    """
+    Decode archived transfers again, without talking to the ring,
+    and replace the stored history that they gave with the result.
+    Optionally specify "op=NAME" (e.g. "op=hrlog"),
+    "from=YYYY-MM-DD[THH:MM]" and "to=YYYY-MM-DD[THH:MM]" (not inclusive)
+    of the time of transfer. Device is the one given with "-a ADDR",
+    or all devices if not given. How many samples each transfer gave
+    is printed.
+    """
+
+    VALID = {"op", "from", "to"}
+    exporter: Optional[Exporter] = None
+
+    def __init__(
+        self, store: Store, addr: Optional[str], **kwargs: Any
+    ) -> None:
+        if set(kwargs.keys()) - self.VALID:
+            raise ValueError("Valid kwargs are " + str(self.VALID))
+        self.store = store
+        self.archive = Archive(store)
+        self.addr = addr
+        self.kwargs = kwargs
+
+    def lines(self) -> Iterator[str]:
+        start = self.kwargs.get("from")
+        end = self.kwargs.get("to")
+        name = self.kwargs.get("op")
+        if name is not None:
+            cls = opclass(name)
+            if cls is None:
+                raise ValueError(f"Unknown op {name}")
+            name = cls.__name__
+        for tid, dev, opname, kwargs, tstart, frames in self.archive.transfers(
+            name,
+            self.addr,
+            None if start is None else timestamp(start),
+            None if end is None else timestamp(end),
+        ):
+            cls = opclass(opname)
+            if cls is None:
+                yield f"{dev} {opname}: unknown op, skipped"
+                continue
+            op = cls(**kwargs)
+            op.when = datetime.fromtimestamp(tstart)
+            for frame in frames:
+                op.recv(None, frame)
+            if not hasattr(op, "records"):
+                yield f"{dev} {opname} {op.when.isoformat()}:"
+                yield op.result()
+                continue
+            recs = op.records()
+            if self.exporter is not None:
+                recs = self.exporter.passing(dev, op, recs)
+            self.store.delete(tid)
+            added = self.store.add(dev, op.METRIC, recs, tid)
+            yield f"{dev} {opname} {op.when.isoformat()}: {added} samples"
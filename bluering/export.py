@@ -0,0 +1,262 @@
+from collections import deque
+from itertools import groupby, islice
+from os import fsync, path, replace
+from sqlite3 import Error as SQLiteError, connect
+from time import monotonic
+from typing import (
+    Any,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Tuple,
+)
+
+from .records import Record
+
+# How many points to write at once
+BATCH = 1000
+# Write what has been collected at least that often, in seconds
+INTERVAL = 10.0
+# How many points to keep while the sink is failing; oldest are dropped
+BACKLOG = 100000
+# How long a history the OpenMetrics file keeps of every series, seconds
+KEEP = 7 * 86400
+
+
+class Point(NamedTuple):
+    metric: str
+    device: str
+    ts: int
+    fields: Tuple[str, ...]
+    values: Tuple[int, ...]
+
+
+def escape(tag: str) -> str:
+    for c in "\\, =":
+        tag = tag.replace(c, "\\" + c)
+    return tag
+
+
+class InfluxSink:
+    """
+    InfluxDB line protocol, appended to a file
+    """
+
+    def __init__(self, fname: str) -> None:
+        self.out = open(fname, "a")
+
+    def write(self, points: List[Point]) -> None:
+        self.out.write(
+            "".join(
+                f"{pt.metric},device={escape(pt.device)} "
+                + ",".join(f"{k}={v}i" for k, v in zip(pt.fields, pt.values))
+                + f" {pt.ts * 1000000000}\n"
+                for pt in points
+            )
+        )
+        self.out.flush()
+
+    def close(self) -> None:
+        self.out.close()
+
+
+class OpenMetricsSink:
+    """
+    OpenMetrics text format in a file. Samples of a family must all be
+    together in the exposition, so they are kept, along with those
+    already in the file, and the file is rewritten in order on every
+    flush. It is written aside and moved over the old one, so that it is
+    always complete. Samples older than KEEP seconds before the newest
+    of their series are dropped.
+    """
+
+    def __init__(self, fname: str) -> None:
+        self.fname = fname
+        # (family, device) -> {ts: value}
+        self.series: Dict[Tuple[str, str], Dict[int, int]] = {}
+        self.dirty = False
+        if path.exists(fname):
+            with open(fname) as f:
+                for line in f:
+                    if line.startswith("#"):
+                        continue
+                    series, value, ts = line.split()
+                    family, _, labels = series.partition("{")
+                    device = labels.split('"')[1]
+                    self.series.setdefault((family, device), {})[int(ts)] = (
+                        int(value)
+                    )
+
+    def write(self, points: List[Point]) -> None:
+        for pt in points:
+            for k, v in zip(pt.fields, pt.values):
+                self.series.setdefault(
+                    (f"bluering_{pt.metric}_{k}", pt.device), {}
+                )[pt.ts] = v
+            self.dirty = True
+
+    def flush(self) -> None:
+        if not self.dirty:
+            return
+        lines = []
+        for family, group in groupby(
+            sorted(self.series.items()), key=lambda s: s[0][0]
+        ):
+            lines.append(f"# TYPE {family} gauge\n")
+            for (_, dev), samples in group:
+                oldest = max(samples) - KEEP
+                for ts in [ts for ts in samples if ts < oldest]:
+                    del samples[ts]
+                lines.extend(
+                    f'{family}{{device="{dev}"}} {samples[ts]} {ts}\n'
+                    for ts in sorted(samples)
+                )
+        lines.append("# EOF\n")
+        with open(self.fname + ".tmp", "w") as out:
+            out.write("".join(lines))
+            out.flush()
+            fsync(out.fileno())
+        replace(self.fname + ".tmp", self.fname)
+        self.dirty = False
+
+    def close(self) -> None:
+        self.flush()
+
+
+class SQLiteSink:
+    """
+    Table of (metric, device, field, ts, value) in an SQLite database
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS points (
+        metric TEXT NOT NULL,
+        device TEXT NOT NULL,
+        field TEXT NOT NULL,
+        ts INTEGER NOT NULL,
+        value INTEGER NOT NULL,
+        PRIMARY KEY (metric, device, field, ts)
+    ) WITHOUT ROWID;
+    """
+
+    def __init__(self, fname: str) -> None:
+        self.db = connect(fname)
+        self.db.executescript(self.SCHEMA)
+
+    def write(self, points: List[Point]) -> None:
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO points VALUES (?, ?, ?, ?, ?)",
+                (
+                    (pt.metric, pt.device, k, pt.ts, v)
+                    for pt in points
+                    for k, v in zip(pt.fields, pt.values)
+                ),
+            )
+
+    def close(self) -> None:
+        self.db.close()
+
+
+SINKS = {
+    "influx": InfluxSink,
+    "openmetrics": OpenMetricsSink,
+    "sqlite": SQLiteSink,
+}
+
+
+class Exporter:
+    """
+    Collects decoded records and writes them to the sink in batches
+    """
+
+    def __init__(
+        self,
+        sink: Any,
+        batch: int = BATCH,
+        interval: float = INTERVAL,
+        backlog: int = BACKLOG,
+    ) -> None:
+        self.sink = sink
+        self.batch = batch
+        self.interval = interval
+        self.pending: Deque[Point] = deque(maxlen=max(backlog, batch))
+        self.flushed = monotonic()
+        self.failing = False  # Then wait for the interval before retrying
+        self.dropped = 0
+        self.written = 0
+
+    def add(self, device: str, op: Any, recs: Iterable[Record]) -> None:
+        for _ in self.passing(device, op, recs):
+            pass
+
+    def passing(
+        self, device: str, op: Any, recs: Iterable[Record]
+    ) -> Iterator[Record]:
+        """
+        Export records as they pass through, so that they can be streamed
+        on to the store without being collected in memory
+        """
+        for rec in recs:
+            if len(self.pending) == self.pending.maxlen:
+                self.dropped += 1
+            self.pending.append(
+                Point(op.METRIC, device, rec.ts, op.FIELDS, rec.values)
+            )
+            if len(self.pending) >= self.batch and not self.failing:
+                self.flush()
+            yield rec
+        if monotonic() - self.flushed >= self.interval:
+            self.flush()
+
+    def flush(self) -> bool:
+        """
+        Write pending points, a batch at a time, then flush the sink if
+        it keeps them. Return False if the sink failed; the points that
+        were not written stay pending.
+        """
+        self.flushed = monotonic()
+        try:
+            while self.pending:
+                points = list(islice(self.pending, self.batch))
+                self.sink.write(points)
+                for _ in points:
+                    self.pending.popleft()
+                self.written += len(points)
+            if hasattr(self.sink, "flush"):
+                self.sink.flush()
+        except (OSError, SQLiteError) as e:
+            print("Export failed, will retry:", e)
+            self.failing = True
+            return False
+        self.failing = False
+        return True
+
+    def close(self) -> None:
+        self.flush()
+        if self.dropped:
+            print("Export backlog overflow,", self.dropped, "points dropped")
+        self.sink.close()
+
+
+def exporter(spec: str) -> Exporter:
+    """
+    Make exporter from "KIND:PATH[,batch=N][,interval=SEC][,backlog=N]",
+    where KIND is one of the SINKS
+    """
+    kind, _, rest = spec.partition(":")
+    fname, *opts = rest.split(",")
+    if kind not in SINKS or not fname:
+        raise ValueError("Export to " + "|".join(SINKS) + ":PATH")
+    parms: Dict[str, Any] = {}
+    for opt in opts:
+        key, _, val = opt.partition("=")
+        if key not in ("batch", "interval", "backlog"):
+            raise ValueError(
+                "Valid export options are batch, interval, backlog"
+            )
+        parms[key] = float(val) if key == "interval" else int(val)
+    return Exporter(SINKS[kind](fname), **parms)
@@ -1,7 +1,17 @@
 from asyncio import Event
 from datetime import date, datetime, timedelta, timezone
 from struct import pack, unpack
-from typing import Any, Dict, List, NamedTuple
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+)
+
+from .records import EPOCH, Record, Samples, midnight, wallclock
 
 verbose: bool = False
 
@@ -11,12 +21,100 @@ def opsv1_verbosity(verbosity: bool) -> None:
     verbose = verbosity
 
 
+FRAME = 16  # All V1 frames are of this size
+
+
 class StepInfo(NamedTuple):
-    date: str
+    ts: int  # seconds on the local wall clock, see wallclock()
     calories: int
     steps: int
     distance: int
 
+    def __repr__(self) -> str:
+        when = EPOCH + timedelta(seconds=self.ts)
+        return (
+            f"StepInfo(date={when.isoformat()!r},"
+            f" calories={self.calories}, steps={self.steps},"
+            f" distance={self.distance})"
+        )
+
+
+def days_of(kwargs: Dict[str, Any], today: date) -> Optional[List[date]]:
+    """
+    Days in the range given by "from=YYYY-MM-DD" and "to=YYYY-MM-DD"
+    (not inclusive, default tomorrow), or "days=N" (N days up to today),
+    oldest first. None if no range is given. The ring has no history
+    after today, so a range that goes past it is refused.
+    """
+    if "days" in kwargs:
+        days = [
+            today - timedelta(days=n)
+            for n in range(int(kwargs["days"]) - 1, -1, -1)
+        ]
+    elif "from" in kwargs:
+        first = date.fromisoformat(kwargs["from"])
+        if "to" in kwargs:
+            end = date.fromisoformat(kwargs["to"])
+        else:
+            end = today + timedelta(days=1)
+        days = [first + timedelta(days=n) for n in range((end - first).days)]
+    else:
+        return None
+    if not days:
+        raise ValueError("Range of days is empty")
+    if days[-1] > today:
+        raise ValueError("Range of days goes past today")
+    return days
+
+
+class Frames:
+    """
+    Received frames, stored back to back in one buffer. Ops that learn
+    from the first frame how many will follow call `reserve()` so that
+    the buffer is allocated once.
+    """
+
+    __slots__ = ("buf", "count")
+
+    def __init__(self) -> None:
+        self.buf = bytearray()
+        self.count = 0
+
+    def reserve(self, count: int) -> None:
+        if len(self.buf) < count * FRAME:
+            self.buf.extend(bytes(count * FRAME - len(self.buf)))
+
+    def append(self, data: bytes) -> None:
+        self.reserve(self.count + 1)
+        pos = self.count * FRAME
+        self.buf[pos : pos + FRAME] = data[:FRAME].ljust(FRAME, b"\0")
+        self.count += 1
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, i: Any) -> Any:
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self.count))]
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError("frame index out of range")
+        return bytes(self.buf[i * FRAME : (i + 1) * FRAME])
+
+    def __iter__(self) -> Iterator[bytes]:
+        return (self[i] for i in range(self.count))
+
+    def payload(self, first: int = 0) -> bytes:
+        """
+        Concatenation of frame contents without opcode, index and checksum
+        """
+        with memoryview(self.buf) as buf:
+            return b"".join(
+                buf[i * FRAME + 2 : (i + 1) * FRAME - 1]
+                for i in range(first, self.count)
+            )
+
 
 class Opv1:
     UART_SRV_UUID = "6e40fff0-b5a3-f393-e0a9-e50e24dcca9e"
@@ -25,13 +123,21 @@ class Opv1:
     OPCODE: int
     MULTI: bool = False
     kwargs: Dict[str, Any]
-    data: List[bytes]
+    data: Frames
     sndbuf: bytes = b""
+    when: datetime  # Reference time for decoding relative dates
 
     def __init__(self, **kwargs: Any) -> None:
         self.kwargs = kwargs
         self.done = Event()
-        self.data = []
+        self.data = Frames()
+        self.when = datetime.now()
+
+    def split(self) -> List["Opv1"]:
+        """
+        Ops to run, one after another, to do what this op is asked to
+        """
+        return [self]
 
     def send(self) -> bytes:
         data = pack("B", self.OPCODE) + self.sndbuf.ljust(14, b"\0")
@@ -54,6 +160,12 @@ class Opv1:
     def result(self) -> str:
         return "\n".join([el.hex() for el in self.data])
 
+    def text(self, recs: Iterable[Record]) -> str:
+        """
+        What to print for the decoded records
+        """
+        return "\n".join(rec.text for rec in recs)
+
 
 class Battery(Opv1):
     """
@@ -61,9 +173,19 @@ class Battery(Opv1):
     """
 
     OPCODE = 0x03
+    METRIC = "battery"
+    FIELDS = ("percent", "charging")
+
+    def records(self) -> Iterator[Record]:
+        pct, charging = self.data[0][1], self.data[0][2]
+        yield Record(
+            round(self.when.timestamp()),
+            (pct, 1 if charging else 0),
+            f"{pct}%{', charging' if charging else ''}",
+        )
 
     def result(self) -> str:
-        return f"{self.data[0][1]}%{', charging' if self.data[0][2] else ''}"
+        return self.text(self.records())
 
 
 class Blink(Opv1):
@@ -83,7 +205,9 @@ class ActLog(Opv1):
     """
 
     OPCODE = 0x43
-    NULTI = True
+    METRIC = "steps"
+    FIELDS = ("calories", "steps", "distance")
+    MULTI = True
     sndbuf = b"\x00\x0f\x00\x5f\x01"
 
     def recv(self, char, data: bytes) -> None:
@@ -92,6 +216,7 @@ class ActLog(Opv1):
                 print("Received", data.hex(), "bad first frame")
             self.frames = data[2]
             # print("expect", self.frames, "more frames")
+            self.data.reserve(self.frames + 1)
             self.count = 0
         else:
             if data[5] != self.count - 1:
@@ -104,9 +229,8 @@ class ActLog(Opv1):
             # print("report done receiving")
             self.done.set()
 
-    def result(self) -> str:
+    def records(self) -> Iterator[Record]:
         new_cal_proto = self.data[0][3] == 1
-        steps = []
         for fr in self.data[1:]:
             y, m, d = (
                 int(el.decode())
@@ -119,10 +243,12 @@ class ActLog(Opv1):
             y += 2000
             if new_cal_proto:
                 cal *= 10
-            steps.append(
-                StepInfo(datetime(y, m, d, hr, mi).isoformat(), cal, st, di)
-            )
-        return "\n".join(str(el) for el in steps)
+            when = datetime(y, m, d, hr, mi)
+            step = StepInfo(round((when - EPOCH).total_seconds()), cal, st, di)
+            yield Record(round(when.timestamp()), step[1:], str(step))
+
+    def result(self) -> str:
+        return self.text(self.records())
 
 
 class SetTime(Opv1):
@@ -166,30 +292,41 @@ class HRLog(Opv1):
     Report one day worth of HR measurements.
     Optionally specify the date of interest in the form "date=YYYY-MM-DD".
     Default is the current day.
+    For a range of days, specify "from=YYYY-MM-DD" and optionally
+    "to=YYYY-MM-DD" (not inclusive, default tomorrow), or "days=N" up to
+    today.
     """
 
     OPCODE = 0x15
+    METRIC = "hr"
+    FIELDS = ("bpm",)
     MULTI = True
 
+    def __init__(self, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        # Checked here, before connecting to the ring
+        self.days = days_of(self.kwargs, self.when.date())
+
+    def split(self) -> List[Opv1]:
+        if self.days is None:
+            return [self]
+        return [HRLog(date=day.isoformat()) for day in self.days]
+
     @property
     def sndbuf(self) -> bytes:
         # opcode + timestamp of past midnight
-        if self.kwargs:
-            ref = datetime.fromisoformat(self.kwargs.get("date"))
+        if "date" in self.kwargs:
+            ref = datetime.fromisoformat(self.kwargs["date"])
         else:
-            ref = datetime.now()
+            ref = self.when
         print("Time ref", ref)
-        TZ = None  # TZ = timezone.utc
-        return pack(
-            "<L",
-            86400
-            + round(datetime(*ref.timetuple()[:3], tzinfo=TZ).timestamp()),
-        )
+        return pack("<L", 86400 + midnight(ref.date()))
 
     def recv(self, char, data: bytes) -> None:
         if not self.data:  # First frame
             self.frames = data[2]
             # print("expect", self.frames, "frames")
+            self.data.reserve(self.frames)
             self.count = 0
         if data[1] != self.count:
             if data[1] == 0xFF:  # No data
@@ -211,21 +348,29 @@ class HRLog(Opv1):
             # print("report done receiving")
             self.done.set()
 
-    def result(self) -> str:
+    def _bulk(self) -> memoryview:
         # We have N frames with 13 bytes of payload in each, and that is
         # a concatanation of 12 byte structures
-        bulk = memoryview(b"".join(buf[2:-1] for buf in self.data))
+        return memoryview(self.data.payload())
+
+    def records(self) -> Samples:
+        samples = Samples()
+        bulk = self._bulk()
         if len(bulk) < 17:
-            return "No HR log data"
+            return samples
         (ts,) = unpack("<L", bulk[13:17])
-        TZ = None  # TZ = timezone.utc
-        log = (
-            f"{datetime.fromtimestamp(ts - 86400 + (i * 300))
-                .astimezone(tz=TZ).isoformat()}: {v}"
-            for i, v in enumerate(bulk[17:])
-            if v
-        )
-        return "\n".join(str(el) for el in log)
+        for i, v in enumerate(bulk[17:]):
+            if v:
+                samples.append(ts - 86400 + (i * 300), v)
+        return samples
+
+    def text(self, recs: Iterable[Record]) -> str:
+        if len(self._bulk()) < 17:
+            return "No HR log data"
+        return super().text(recs)
+
+    def result(self) -> str:
+        return self.text(self.records())
 
 
 # class HRVLog(Opv1):
@@ -241,21 +386,47 @@ class HRLog(Opv1):
 class StressLog(Opv1):
     """
     Report day's worth of stress history
-    Specify days ago as "ago=N"
+    Specify days ago as "ago=N", at most 255
+    For a range of days, specify "from=YYYY-MM-DD" and optionally
+    "to=YYYY-MM-DD" (not inclusive, default tomorrow), or "days=N" up to
+    today.
     """
 
     OPCODE = 0x37
+    METRIC = "stress"
+    FIELDS = ("level",)
     MULTI = True
+    MAX_AGO = 255  # Days ago are sent in one byte
+
+    def __init__(self, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        # Checked here, before connecting to the ring
+        today = self.when.date()
+        days = days_of(self.kwargs, today)
+        self.agos = (
+            None if days is None else [(today - day).days for day in days]
+        )
+        for ago in self.agos or [int(self.kwargs.get("ago", 0))]:
+            if not 0 <= ago <= self.MAX_AGO:
+                raise ValueError(
+                    f"Stress history goes back at most {self.MAX_AGO} days"
+                )
+
+    def split(self) -> List[Opv1]:
+        if self.agos is None:
+            return [self]
+        return [StressLog(ago=str(ago)) for ago in self.agos]
 
     @property
     def sndbuf(self) -> bytes:
-        # opcode + timestamp of past midnight
+        # opcode + number of days ago
         ago = self.kwargs.get("ago", 0)
         return pack("B", int(ago))
 
     def recv(self, char, data: bytes) -> None:
         if not self.data:  # First frame
             self.frames = data[2]
+            self.data.reserve(self.frames)
             self.count = 0
         if data[1] != self.count:
             if data[1] == 0xFF:  # No data
@@ -275,20 +446,25 @@ class StressLog(Opv1):
         if self.count >= self.frames:
             self.done.set()
 
-    def result(self) -> str:
-        bulk = memoryview(b"".join(buf[2:-1] for buf in self.data[1:]))
-        period = self.data[0][3]
+    @property
+    def period(self) -> int:
+        return self.data[0][3]
+
+    def records(self) -> Samples:
+        samples = Samples(wall=True)
+        if not self.data:  # Ring said there is no data
+            return samples
+        bulk = memoryview(self.data.payload(1))
+        period = self.period
         ago = bulk[0]
-        datedrecs = (
-            (
-                datetime(*date.today().timetuple()[:6])
-                - timedelta(days=ago)
-                + timedelta(minutes=(i * period)),
-                v,
-            )
-            for i, v in enumerate(bulk[1:-3])
-        )
-        return "\n".join(f"{t.isoformat()}: {v}" for t, v in datedrecs if v)
+        start = wallclock(self.when.date() - timedelta(days=ago))
+        for i, v in enumerate(bulk[1:-3]):
+            if v:
+                samples.append(start + i * period * 60, v)
+        return samples
+
+    def result(self) -> str:
+        return self.text(self.records())
 
 
 class UserPref(Opv1):
@@ -365,12 +541,20 @@ class HRPref(Opv1):
         else:
             return b"\x01"
 
+    @property
+    def enabled(self) -> bool:
+        return self.data[0][2] == 1
+
+    @property
+    def period(self) -> int:
+        return self.data[0][3]
+
     def result(self) -> str:
         if self.kwargs:
             return "Done, hopefully"
         return (
-            f"{'enabled' if self.data[0][2] == 1 else 'disabled'},"
-            f" period {self.data[0][3]} min"
+            f"{'enabled' if self.enabled else 'disabled'},"
+            f" period {self.period} min"
         )
 
 
@@ -393,10 +577,14 @@ class _SimplePref(Opv1):
         else:
             return b"\x01"
 
+    @property
+    def enabled(self) -> bool:
+        return self.data[0][2] == 1
+
     def result(self) -> str:
         if self.kwargs:
             return "Done, hopefully"
-        return f"{'enabled' if self.data[0][2] == 1 else 'disabled'}"
+        return f"{'enabled' if self.enabled else 'disabled'}"
 
 
 class SpO2Pref(_SimplePref):
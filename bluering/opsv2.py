@@ -1,7 +1,9 @@
 from asyncio import Event
 from datetime import date, datetime, timedelta, timezone
 from struct import pack, unpack
-from typing import Any, Dict
+from typing import Any, Dict, Iterable, Iterator, List
+
+from .records import Record
 
 verbose: bool = False
 
@@ -17,15 +19,24 @@ class Opv2:
     UART_NOT_UUID = "de5bf729-d711-4e47-af26-65e3012a5dc7"
     OPCODE: int
     kwargs: Dict[str, Any]
-    data: bytes
+    data: bytearray
     sndbuf: bytes = b""
+    when: datetime  # Reference time for decoding relative dates
 
     def __init__(self, **kwargs: Any) -> None:
         self.kwargs = kwargs
         self.done = Event()
-        self.data = b""
+        self.data = bytearray()
+        self.when = datetime.now()
+        self.got = 0
         self.expect = 0
 
+    def split(self) -> List["Opv2"]:
+        """
+        Ops to run, one after another, to do what this op is asked to
+        """
+        return [self]
+
     def send(self) -> bytes:
         data = b"\xbc" + pack("B", self.OPCODE) + self.sndbuf
         return data + pack("B", sum(data) % 256)
@@ -33,7 +44,10 @@ class Opv2:
     def recv(self, char, data: bytes) -> None:
         if verbose:
             print(self.__class__.__name__, "received:", data.hex())
-        if not self.data:  # First frame
+        if self.done.is_set():  # Payload is exported, buffer must stay
+            print("Extra data after the packet", data.hex())
+            return
+        if not self.got:  # First frame
             if len(data) < 6:
                 print("Too short data", data.hex())
                 return
@@ -45,13 +59,25 @@ class Opv2:
             self.expect = (data[3] << 8) | data[2]
             if verbose:
                 print("Expect packet size", self.expect)
-        self.data = self.data + data
-        if len(self.data) >= self.expect + 6:
+            # Header and payload, allocated once
+            self.data = bytearray(self.expect + 6)
+        end = self.got + len(data)
+        if end > len(self.data):
+            self.data.extend(bytes(end - len(self.data)))
+        self.data[self.got : end] = data
+        self.got = end
+        if self.got >= self.expect + 6:
             self.payload = memoryview(self.data)[6 : 6 + self.expect]
             self.done.set()
 
     def result(self) -> str:
-        return self.data.hex()
+        return self.data[: self.got].hex()
+
+    def text(self, recs: Iterable[Record]) -> str:
+        """
+        What to print for the decoded records
+        """
+        return "\n".join(rec.text for rec in recs)
 
 
 class SPO2Log(Opv2):
@@ -60,10 +86,12 @@ class SPO2Log(Opv2):
     """
 
     OPCODE = 0x2A
+    METRIC = "spo2"
+    FIELDS = ("low", "high")
 
     sndbuf = b"\x01\x00\xff\x00\xff"
 
-    def result(self) -> str:
+    def records(self) -> Iterator[Record]:
         days, rest = divmod(len(self.payload), 49)
         if rest:
             print("payload is not a round number of days", self.payload.hex())
@@ -76,24 +104,27 @@ class SPO2Log(Opv2):
             )
             if day
         )
+        today = self.when.date()
         dated_recs = (
             (
                 datetime(
-                    *(
-                        (date.today() - timedelta(days=ddif)).timetuple()[:3]
-                        + (hr,)
-                    )
+                    *((today - timedelta(days=ddif)).timetuple()[:3] + (hr,))
                 ),
                 lo,
                 hi,
             )
             for ddif, hr, lo, hi in recs
         )
-        return "\n".join(
-            f"{dt.isoformat()}: {lo} - {hi}"
-            for dt, lo, hi in dated_recs
-            if lo or hi
-        )
+        for dt, lo, hi in dated_recs:
+            if lo or hi:
+                yield Record(
+                    round(dt.timestamp()),
+                    (lo, hi),
+                    f"{dt.isoformat()}: {lo} - {hi}",
+                )
+
+    def result(self) -> str:
+        return self.text(self.records())
 
 
 class SleepLog(Opv2):
@@ -102,12 +133,17 @@ class SleepLog(Opv2):
     """
 
     OPCODE = 0x27
+    METRIC = "sleep"
+    FIELDS = ("minutes", "light", "deep", "rem", "awake")
+    LEGEND = (
+        "(Sleep start - end (total); minutes [l]ight/[d]eep sleep, [a]wake)"
+    )
 
     sndbuf = b"\x01\x00\xff\x00\xff"
 
-    def result(self) -> str:
+    def records(self) -> Iterator[Record]:
         numdays = self.payload[0]
-        today = date.today()
+        today = self.when.date()
 
         def days() -> bytes:
             rest = self.payload[1:]
@@ -127,21 +163,33 @@ class SleepLog(Opv2):
         def sleepmode(i: int) -> str:
             return {2: "l", 3: "d", 4: "r", 5: "a"}.get(i, "?")
 
-        output = ""
         for ago, cont in days():
             sleepstart, sleepend = unpack("<HH", cont[:4])
             if sleepstart > sleepend:
                 sleepstart -= 1440  # minutes in the day
             beg = timeof(ago, sleepstart)
             end = timeof(ago, sleepend)
-            hr, mi = divmod((end - beg).seconds // 60, 60)
-            output += (
+            total = (end - beg).seconds // 60
+            hr, mi = divmod(total, 60)
+            phases = [
+                (cont[4:][i * 2], cont[4:][i * 2 + 1])
+                for i in range(0, (len(cont) - 4) // 2)
+            ]
+            yield Record(
+                round(beg.timestamp()),
+                (total,)
+                + tuple(
+                    sum(mins for mode, mins in phases if mode == want)
+                    for want in (2, 3, 4, 5)
+                ),
                 f"{beg.isoformat()} - {end.isoformat()} ({hr}:{mi:02})\n\t"
                 + ", ".join(
-                    f"{cont[4:][i * 2 + 1]}{sleepmode(cont[4:][i * 2])}"
-                    for i in range(0, (len(cont) - 4) // 2)
-                )
-                + "\n"
+                    f"{mins}{sleepmode(mode)}" for mode, mins in phases
+                ),
             )
-        output += "(Sleep start - end (total); minutes [l]ight/[d]eep sleep, [a]wake)"
-        return output
+
+    def text(self, recs: Iterable[Record]) -> str:
+        return "\n".join([rec.text for rec in recs] + [self.LEGEND])
+
+    def result(self) -> str:
+        return self.text(self.records())
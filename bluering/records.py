@@ -0,0 +1,100 @@
+from array import array
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Iterator, NamedTuple, Optional, Tuple
+
+
+class Record(NamedTuple):
+    """
+    One decoded history sample: time (seconds since the epoch),
+    numeric values in the order of the op's FIELDS, and the text
+    that the op prints for it.
+    """
+
+    ts: int
+    values: Tuple[int, ...]
+    text: str
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+@lru_cache(maxsize=64)
+def midnight(day: date) -> int:
+    """
+    Local midnight of the day, in seconds since the epoch
+    """
+    return round(datetime(*day.timetuple()[:3]).timestamp())
+
+
+@lru_cache(maxsize=64)
+def dayzone(day: date) -> Optional[timezone]:
+    """
+    Local timezone offset of the day, or None if it changes during the day
+    """
+    start = midnight(day)
+    first = datetime.fromtimestamp(start).astimezone().utcoffset()
+    last = datetime.fromtimestamp(start + 86399).astimezone().utcoffset()
+    if first is None or first != last:
+        return None
+    return timezone(first)
+
+
+def wallclock(day: date) -> int:
+    """
+    Midnight of the day on the local wall clock, in seconds since
+    1970-01-01 00:00 on the same clock
+    """
+    return (day - EPOCH.date()).days * 86400
+
+
+class Samples:
+    """
+    Batch of single-valued samples, kept in arrays rather than as separate
+    objects. Records are made one at a time when iterated over.
+    Timestamps are either seconds since the epoch, printed with UTC offset,
+    or, with `wall`, seconds on the local wall clock (see `wallclock()`),
+    printed as they are. Timezone is looked up once per day.
+    """
+
+    __slots__ = ("ts", "values", "wall")
+
+    def __init__(self, wall: bool = False) -> None:
+        self.ts = array("q")
+        self.values = array("H")
+        self.wall = wall
+
+    def append(self, ts: int, value: int) -> None:
+        self.ts.append(ts)
+        self.values.append(value)
+
+    def __len__(self) -> int:
+        return len(self.ts)
+
+    def __iter__(self) -> Iterator[Record]:
+        start = end = 0  # Of the day of the previous sample
+        tz: Optional[timezone] = None
+        for ts, v in zip(self.ts, self.values):
+            if not start <= ts < end:
+                if self.wall:
+                    day = (EPOCH + timedelta(seconds=ts)).date()
+                    start = wallclock(day)
+                    end = start + 86400
+                else:
+                    day = date.fromtimestamp(ts)
+                    start = midnight(day)
+                    end = midnight(day + timedelta(days=1))
+                tz = dayzone(day)
+            if self.wall:
+                when = EPOCH + timedelta(seconds=ts)
+                if tz is None:  # Daylight saving time changes this day
+                    epoch = round(when.timestamp())
+                else:
+                    epoch = ts - round(tz.utcoffset(None).total_seconds())
+            else:
+                epoch = ts
+                if tz is None:  # Daylight saving time changes this day
+                    when = datetime.fromtimestamp(ts).astimezone()
+                else:
+                    when = datetime.fromtimestamp(ts, tz)
+            yield Record(epoch, (v,), f"{when.isoformat()}: {v}")
@@ -0,0 +1,105 @@
+from array import array
+from asyncio import wait_for
+from time import monotonic, time
+from typing import Optional, Set, Type, Union
+
+from bleak import BleakClient
+
+from .archive import Archive
+from .opsv1 import Opv1
+from .opsv2 import Opv2
+
+Op = Union[Opv1, Opv2]
+
+# Frames with this opcode on the V1 notification characteristic are not
+# responses to our requests, but unsolicited notifications from the ring.
+CMD_NOTIFICATION = 0x73
+
+# How long to wait for the ring to finish responding to an op, in seconds
+TIMEOUT = 30.0
+
+
+class Session:
+    """
+    Connection to a ring, over which several ops can be run in sequence.
+    Unsolicited notifications that arrive meanwhile are collected in
+    `notified` (by notification type). If an archive is given, raw frames
+    received for each op are saved there, and `transfer` is the id
+    under which the last op was saved.
+    """
+
+    def __init__(
+        self, client: BleakClient, archive: Optional[Archive] = None
+    ) -> None:
+        self.client = client
+        self.archive = archive
+        self.op: Optional[Op] = None
+        # Frames received for the op, back to back, and their sizes
+        self.stream = bytearray()
+        self.sizes = array("H")
+        self.transfer: Optional[int] = None
+        self.subscribed: Set[Type] = set()
+        self.notified: Set[int] = set()
+
+    async def subscribe(self, proto: Type) -> bool:
+        if proto in self.subscribed:
+            return True
+        srvd = {srv.uuid: srv for srv in self.client.services}
+        if proto.UART_SRV_UUID not in srvd:
+            print("Service", proto.UART_SRV_UUID, "not found")
+            return False
+        if {proto.UART_WRT_UUID, proto.UART_NOT_UUID} != {
+            c.uuid for c in srvd[proto.UART_SRV_UUID].characteristics
+        }:
+            print("Characteristics not found")
+            return False
+        await self.client.start_notify(
+            proto.UART_NOT_UUID,
+            lambda char, data: self.recv(proto, char, data),
+        )
+        self.subscribed.add(proto)
+        return True
+
+    def recv(self, proto: Type, char, data: bytes) -> None:
+        if proto is Opv1 and data and data[0] == CMD_NOTIFICATION:
+            if len(data) > 1:
+                self.notified.add(data[1])
+            return
+        # Late frames of a previous op of the other protocol are dropped
+        if isinstance(self.op, proto):
+            self.stream += data
+            self.sizes.append(len(data))
+            self.op.recv(char, data)
+
+    async def run(self, op: Op) -> Optional[float]:
+        """
+        Run the op, return the time it took in seconds,
+        or None if the ring does not support it. Raise TimeoutError
+        if the ring does not finish responding in TIMEOUT seconds.
+        """
+        proto = Opv1 if isinstance(op, Opv1) else Opv2
+        if not await self.subscribe(proto):
+            return None
+        start = monotonic()
+        wallstart = time()
+        self.stream = bytearray()
+        self.sizes = array("H")
+        self.op = op
+        self.transfer = None
+        try:
+            await self.client.write_gatt_char(
+                op.UART_WRT_UUID, op.send(), response=False
+            )
+            await wait_for(op.done.wait(), TIMEOUT)
+        finally:
+            self.op = None
+        if self.archive is not None:
+            self.transfer = self.archive.add(
+                self.client.address,
+                op,
+                self.stream,
+                self.sizes,
+                wallstart,
+                time(),
+            )
+        return monotonic() - start
@@ -0,0 +1,214 @@
+from datetime import datetime
+from os import makedirs, path
+from sqlite3 import connect
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+from .records import Record
+
+DEFAULT_STORE = path.expanduser("~/.local/share/bluering/store.db")
+
+# Samples are keyed by (metric, device, ts), so that pulling overlapping
+# history windows does not produce duplicates, and time range lookups for
+# a metric of a device are B-tree range scans over the primary key.
+# The secondary index serves time range queries over all devices.
+# Samples remember the archived transfer that they were decoded from, so
+# that decoding it again replaces exactly them. When transfers overlap,
+# the sample belongs to the latest one.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    metric TEXT NOT NULL,
+    device TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    line TEXT NOT NULL,
+    transfer INTEGER,
+    PRIMARY KEY (metric, device, ts)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS samples_ts ON samples (metric, ts);
+CREATE TABLE IF NOT EXISTS syncstate (
+    device TEXT NOT NULL,
+    name TEXT NOT NULL,
+    last INTEGER NOT NULL,
+    period INTEGER NOT NULL,
+    enabled INTEGER NOT NULL,
+    took REAL NOT NULL,
+    PRIMARY KEY (device, name)
+) WITHOUT ROWID;
+"""
+
+
+class SyncState(NamedTuple):
+    last: int  # when last pulled, seconds since the epoch
+    period: int  # how often the ring produces new data, in minutes
+    enabled: bool  # whether the ring collects the data at all
+    took: float  # how long the last pull took, in seconds
+
+
+class Store:
+    """
+    Local store of decoded history, in an SQLite database
+    """
+
+    def __init__(self, fname: str = DEFAULT_STORE) -> None:
+        if path.dirname(fname):
+            makedirs(path.dirname(fname), exist_ok=True)
+        self.db = connect(fname)
+        self.db.executescript(SCHEMA)
+        if "transfer" not in {
+            col[1] for col in self.db.execute("PRAGMA table_info(samples)")
+        }:
+            self.db.execute("ALTER TABLE samples ADD COLUMN transfer INTEGER")
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS samples_transfer"
+            " ON samples (transfer)"
+        )
+
+    def close(self) -> None:
+        self.db.close()
+
+    def add(
+        self,
+        device: str,
+        metric: str,
+        recs: Iterable[Record],
+        transfer: Optional[int] = None,
+    ) -> int:
+        """
+        Add samples decoded from the transfer, unless a later transfer
+        already has them
+        """
+        with self.db:
+            cur = self.db.executemany(
+                "INSERT INTO samples VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT (metric, device, ts) DO UPDATE"
+                " SET line = excluded.line, transfer = excluded.transfer"
+                " WHERE excluded.transfer IS NULL"
+                " OR samples.transfer IS NULL"
+                " OR excluded.transfer >= samples.transfer",
+                ((metric, device, rec.ts, rec.text, transfer) for rec in recs),
+            )
+        return cur.rowcount
+
+    def delete(self, transfer: int) -> int:
+        """
+        Delete samples that belong to the transfer
+        """
+        with self.db:
+            cur = self.db.execute(
+                "DELETE FROM samples WHERE transfer = ?", (transfer,)
+            )
+        return cur.rowcount
+
+    def syncstate(self, device: str) -> Dict[str, SyncState]:
+        return {
+            name: SyncState(last, period, bool(enabled), took)
+            for name, last, period, enabled, took in self.db.execute(
+                "SELECT name, last, period, enabled, took FROM syncstate"
+                " WHERE device = ?",
+                (device,),
+            )
+        }
+
+    def set_syncstate(self, device: str, name: str, st: SyncState) -> None:
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO syncstate VALUES (?, ?, ?, ?, ?, ?)",
+                (device, name, *st),
+            )
+
+    def metrics(self) -> List[str]:
+        """
+        Metrics that have samples, each found with one index lookup
+        """
+        found: List[str] = []
+        (metric,) = self.db.execute(
+            "SELECT MIN(metric) FROM samples"
+        ).fetchone()
+        while metric is not None:
+            found.append(metric)
+            (metric,) = self.db.execute(
+                "SELECT MIN(metric) FROM samples WHERE metric > ?", (metric,)
+            ).fetchone()
+        return found
+
+    def query(
+        self,
+        metric: Optional[str] = None,
+        device: Optional[str] = None,
+        start: Optional[int] = None,
+        end: Optional[int] = None,
+    ) -> Iterator[Tuple[str, str, int, str]]:
+        """
+        Yield (metric, device, ts, line) for samples with start <= ts < end,
+        grouped by metric, ordered by time within the group.
+        Metrics are queried one at a time, so that every lookup is
+        a range scan over an index rather than a scan of the table.
+        """
+        conds = ["metric = ?"]
+        parms: list = [None]
+        for cond, val in (
+            ("device = ?", device),
+            ("ts >= ?", start),
+            ("ts < ?", end),
+        ):
+            if val is not None:
+                conds.append(cond)
+                parms.append(val)
+        sql = (
+            "SELECT metric, device, ts, line FROM samples WHERE "
+            + " AND ".join(conds)
+            + " ORDER BY ts, device"
+        )
+        for mtr in self.metrics() if metric is None else [metric]:
+            parms[0] = mtr
+            yield from self.db.execute(sql, parms)
+
+
+def timestamp(when: str) -> int:
+    return round(datetime.fromisoformat(when).timestamp())
+
+
+class Query:
+    """
+    Report stored history without talking to the ring.
+    Optionally specify "metric={hr|stress|spo2|steps|sleep|battery}",
+    "from=YYYY-MM-DD[THH:MM]" and "to=YYYY-MM-DD[THH:MM]" (not inclusive).
+    Device is the one given with "-a ADDR". If not given, samples from all
+    devices are reported, prefixed with the device address.
+    Stored history is text only, so it cannot be exported with "-e".
+    """
+
+    VALID = {"metric", "from", "to"}
+
+    def __init__(
+        self, store: Store, addr: Optional[str], **kwargs: Any
+    ) -> None:
+        if set(kwargs.keys()) - self.VALID:
+            raise ValueError("Valid kwargs are " + str(self.VALID))
+        self.store = store
+        self.addr = addr
+        self.kwargs = kwargs
+
+    def lines(self) -> Iterator[str]:
+        start = self.kwargs.get("from")
+        end = self.kwargs.get("to")
+        metric = self.kwargs.get("metric")
+        group = None
+        for mtr, dev, _, line in self.store.query(
+            metric,
+            self.addr,
+            None if start is None else timestamp(start),
+            None if end is None else timestamp(end),
+        ):
+            if metric is None and group != mtr:
+                group = mtr
+                yield f"{mtr}:"
+            yield line if self.addr else f"{dev} {line}"
@@ -0,0 +1,233 @@
+from asyncio import TimeoutError, gather, sleep
+from datetime import date
+from time import monotonic, time
+from typing import Any, Dict, List, Optional, Tuple
+
+from bleak.backends.device import BLEDevice
+from bleak.exc import BleakError
+
+from .adapters import AdapterPool
+from .archive import Archive
+from .export import Exporter
+from .opsv1 import (
+    ActLog,
+    Battery,
+    HRLog,
+    HRPref,
+    SpO2Pref,
+    StressLog,
+    StressPref,
+)
+from .opsv2 import SleepLog, SPO2Log
+from .session import Session
+from .store import Store, SyncState
+
+# Types of unsolicited notifications that the ring sends on new data
+NEW_HR_DATA = 0x01
+NEW_SPO2_DATA = 0x03
+NEW_STEPS_DATA = 0x04
+
+# History op, op that reports if the history is collected at all,
+# notification that new data is there, and default period in minutes
+HISTORY = (
+    (HRLog, HRPref, NEW_HR_DATA, 5),
+    (StressLog, StressPref, None, 30),
+    (SPO2Log, SpO2Pref, NEW_SPO2_DATA, 60),
+    (ActLog, None, NEW_STEPS_DATA, 15),
+    (SleepLog, None, None, 1440),
+)
+
+# History ops that return one day per request. To catch up after a break
+# in syncing, they are pulled for every day since the last pull, but for
+# no more than the days that the ring keeps.
+DAILY = (HRLog, StressLog)
+CATCHUP_DAYS = 7
+
+# Pseudo op name to keep time spent to connect and check status
+CONNECT = "connect"
+
+
+def due(st: Optional[SyncState], now: float) -> bool:
+    return st is None or (st.enabled and now >= st.last + st.period * 60)
+
+
+def pull(logop: Any, st: Optional[SyncState], now: float) -> Any:
+    """
+    Op that gets the history that was not pulled yet
+    """
+    if logop not in DAILY:
+        return logop()
+    if st is None:
+        days = CATCHUP_DAYS
+    else:
+        days = (date.fromtimestamp(now) - date.fromtimestamp(st.last)).days
+        days = min(days + 1, CATCHUP_DAYS)
+    return logop(days=str(days))
+
+
+class Sync:
+    """
+    Pull history that the ring is likely to have got since the last sync.
+    Status of all rings is checked, and due history pulled, over one
+    connection per ring. Disabled logs are skipped, and rings that have
+    nothing due are not connected to at all. Rings are synced concurrently,
+    spread over the adapters given with "-i". Rings that are not heard
+    within the scan timeout are left for the next round.
+    Specify "loop=yes" to keep running, syncing each ring when it is due.
+    """
+
+    VALID = {"loop"}
+
+    def __init__(
+        self,
+        store: Store,
+        pool: AdapterPool,
+        exporter: Optional[Exporter] = None,
+        **kwargs: Any,
+    ) -> None:
+        if set(kwargs.keys()) - self.VALID:
+            raise ValueError("Valid kwargs are " + str(self.VALID))
+        self.store = store
+        self.pool = pool
+        self.exporter = exporter
+        self.archive = Archive(store)
+        self.loop = kwargs.get("loop", "no") == "yes"
+        self.radio = 0.0  # time spent connected
+        self.status = 0.0  # of that, time spent connecting and checking
+        self.saved = 0.0  # time that pulls that we skipped took last time
+        self.pulled = 0
+        self.skipped = 0
+
+    def save(self, device: str, op: Any, transfer: Optional[int]) -> int:
+        recs = op.records()
+        if self.exporter is not None:
+            recs = self.exporter.passing(device, op, recs)
+        return self.store.add(device, op.METRIC, recs, transfer)
+
+    def skip(self, st: Optional[SyncState]) -> None:
+        self.skipped += 1
+        if st is not None:
+            self.saved += st.took
+
+    async def status_check(
+        self, session: Session, device: str
+    ) -> Optional[Dict[str, Tuple[bool, Optional[int]]]]:
+        """
+        Return {metric: (enabled, period)}, period is None if the ring
+        does not tell it.
+        """
+        battery = Battery()
+        if await session.run(battery) is None:
+            return None
+        self.save(device, battery, session.transfer)
+        status = {}
+        for logop, prefop, _, _ in HISTORY:
+            if prefop is None:
+                status[logop.METRIC] = (True, None)
+                continue
+            pref = prefop()
+            await session.run(pref)
+            status[logop.METRIC] = (
+                pref.enabled,
+                pref.period if isinstance(pref, HRPref) else None,
+            )
+        return status
+
+    async def sync_ring(self, dev: BLEDevice) -> None:
+        states = self.store.syncstate(dev.address)
+        now = time()
+        if CONNECT in states and not any(
+            due(states.get(logop.METRIC), now) for logop, _, _, _ in HISTORY
+        ):
+            print(dev.address, "nothing due")
+            self.saved += states[CONNECT].took
+            for logop, _, _, _ in HISTORY:
+                self.skip(states.get(logop.METRIC))
+            return
+        start = monotonic()
+        async with self.pool.connect(dev) as client:
+            session = Session(client, self.archive)
+            status = await self.status_check(session, dev.address)
+            if status is None:
+                return
+            took = monotonic() - start
+            self.status += took
+            self.store.set_syncstate(
+                dev.address, CONNECT, SyncState(round(now), 0, True, took)
+            )
+            for logop, _, notif, defperiod in HISTORY:
+                metric = logop.METRIC
+                st = states.get(metric)
+                enabled, period = status[metric]
+                if period is None:
+                    period = defperiod if st is None else st.period
+                if not enabled or (
+                    st is not None
+                    and notif not in session.notified
+                    and now < st.last + period * 60
+                ):
+                    self.skip(st)
+                    if st is not None:
+                        self.store.set_syncstate(
+                            dev.address,
+                            metric,
+                            st._replace(period=period, enabled=enabled),
+                        )
+                    continue
+                added = 0
+                for op in pull(logop, st, now).split():
+                    # Of the last day, that is what the next pull will take
+                    took = await session.run(op)
+                    if took is None:
+                        break
+                    added += self.save(dev.address, op, session.transfer)
+                    if isinstance(op, StressLog) and op.data:
+                        period = op.period
+                if took is None:
+                    continue
+                self.pulled += 1
+                print(dev.address, metric, added, "samples")
+                self.store.set_syncstate(
+                    dev.address,
+                    metric,
+                    SyncState(round(now), period, enabled, took),
+                )
+            await client.disconnect()
+        self.radio += monotonic() - start
+
+    async def sync_one(self, dev: BLEDevice) -> None:
+        try:
+            await self.sync_ring(dev)
+        except (BleakError, OSError, TimeoutError) as e:
+            print(dev.address, "sync failed:", e)
+
+    def next_due(self, devs: List[BLEDevice]) -> float:
+        return min(
+            (
+                st.last + st.period * 60
+                for dev in devs
+                for name, st in self.store.syncstate(dev.address).items()
+                if name != CONNECT and st.enabled
+            ),
+            default=time(),
+        )
+
+    def report(self) -> str:
+        return (
+            f"Pulled {self.pulled}, skipped {self.skipped} logs."
+            f" Radio on {self.radio:.1f}s, of that {self.status:.1f}s"
+            f" connecting and checking status."
+            f" Skipping saved about {self.saved:.1f}s."
+        )
+
+    async def run(self, addrs: Optional[List[str]]) -> None:
+        while True:
+            # Scan every time, for rings that were out of range before
+            devs = await self.pool.scan(addrs)
+            await gather(*(self.sync_one(dev) for dev in devs))
+            if self.exporter is not None:
+                self.exporter.flush()
+            print(self.report())
+            if not self.loop:
+                return
+            await sleep(max(60.0, self.next_due(devs) - time()))
@@ -0,0 +1,399 @@
+#!/usr/bin/python3
+
+# Synthetic benchmarks for the parts of bluering that do not need a ring.
+# Run from the source tree: python3 scripts/benchmark.py [name ...]
+
+from asyncio import Lock, get_running_loop, run, gather, sleep
+from contextlib import redirect_stdout
+from datetime import datetime
+from os import devnull, path, unlink
+from random import randrange, seed
+from sys import argv, path as syspath
+from tempfile import mkdtemp
+from struct import pack, unpack
+from time import perf_counter
+from tracemalloc import get_traced_memory, start as trace, stop as untrace
+
+syspath.insert(0, path.join(path.dirname(path.abspath(__file__)), ".."))
+
+from bluering.adapters import ADV_SRV_UUID, AdapterPool, Backend
+from bluering.export import SINKS, Exporter
+from bluering.opsv1 import ActLog, HRLog, Opv1, StressLog
+from bluering.opsv2 import Opv2, SPO2Log
+from bluering.records import Record
+from bluering.store import Query, Store
+from bluering.sync import Sync
+
+RINGS = 36
+DAYS = 365
+BASE = 1700000000 - 1700000000 % 86400
+
+
+def ring(n):
+    return f"AA:BB:CC:DD:{n // 256:02X}:{n % 256:02X}"
+
+
+def bench_store():
+    """
+    Time range queries over a year of 5-minute HR and 30-minute stress
+    samples for 36 rings
+    """
+    fname = path.join(mkdtemp(), "store.db")
+    store = Store(fname)
+    seed(42)
+    start = perf_counter()
+    total = 0
+    for metric, period in (("hr", 300), ("stress", 1800)):
+        for n in range(RINGS):
+            total += store.add(
+                ring(n),
+                metric,
+                (
+                    Record(ts, (v,), f"{ts}: {v}")
+                    for ts, v in (
+                        (BASE + i * period, randrange(50, 120))
+                        for i in range(DAYS * 86400 // period)
+                    )
+                ),
+            )
+    print(f"store: loaded {total} samples in {perf_counter() - start:.1f}s")
+    for desc, kwargs, addr, metric in (
+        ("2h, one ring, hr", {"from": 7200, "to": 14400}, ring(7), "hr"),
+        ("1 day, one ring, hr", {"from": 0, "to": 86400}, ring(7), "hr"),
+        ("2h, all rings, hr", {"from": 7200, "to": 14400}, None, "hr"),
+        ("2h, one ring, all", {"from": 7200, "to": 14400}, ring(7), None),
+        ("2h, all rings, all", {"from": 7200, "to": 14400}, None, None),
+    ):
+        rounds = 100
+        start = perf_counter()
+        for i in range(rounds):
+            off = BASE + (i * 86400 * 3) % (DAYS * 86400)
+            lines = sum(
+                1
+                for _ in Query(
+                    store,
+                    addr,
+                    **({} if metric is None else {"metric": metric}),
+                    **{
+                        k: datetime.fromtimestamp(off + v).isoformat()
+                        for k, v in kwargs.items()
+                    },
+                ).lines()
+            )
+        took = (perf_counter() - start) / rounds
+        print(f"store: {desc}: {lines} lines, {took * 1000:.2f} ms/query")
+    store.close()
+    unlink(fname)
+
+
+class FakeAdapter:
+    """Airtime of an adapter is shared by all its connections"""
+
+    def __init__(self, name, failrate):
+        self.name = name
+        self.air = Lock()
+        self.failrate = failrate
+
+
+class FakeClient:
+    FRAME_TIME = 0.0005
+
+    def __init__(self, adapter):
+        self.adapter = adapter
+
+    async def connect(self):
+        await sleep(0.01)
+        if randrange(100) < self.adapter.failrate:
+            raise OSError(f"{self.adapter.name}: connection failed")
+
+    async def disconnect(self):
+        pass
+
+    async def transfer(self, frames):
+        for _ in range(frames):
+            async with self.adapter.air:
+                await sleep(self.FRAME_TIME)
+
+
+class FakeAdvertisement:
+    def __init__(self, rssi):
+        self.rssi = rssi
+        self.service_uuids = [ADV_SRV_UUID]
+
+
+class FakeScanner:
+    """Every adapter hears every ring, with its own signal strength"""
+
+    def __init__(self, devs):
+        self.devs = devs
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    async def advertisement_data(self):
+        while True:
+            for dev in self.devs:
+                await sleep(0.001)
+                yield dev, FakeAdvertisement(-40 - randrange(50))
+
+
+class FakeBackend(Backend):
+    def __init__(self, adapters, devs):
+        self.adapters = adapters
+        self.devs = devs
+
+    def scanner(self, adapter):
+        return FakeScanner(self.devs)
+
+    def client(self, dev, adapter):
+        return FakeClient(self.adapters[adapter])
+
+
+class FakeDevice:
+    def __init__(self, address):
+        self.address = address
+        self.name = "R02"
+
+
+def bench_adapters():
+    """Rings synced per second as adapters are added (simulated airtime)"""
+
+    async def sync(pool, devs):
+        async def one(dev):
+            async with pool.connect(dev) as client:
+                await client.transfer(100)
+
+        await gather(*(one(dev) for dev in devs))
+
+    devs = [FakeDevice(ring(n)) for n in range(RINGS)]
+    for count in range(1, 5):
+        names = [f"hci{n}" for n in range(count)]
+        # Every adapter but the first fails some connections
+        adapters = {
+            name: FakeAdapter(name, 0 if n == 0 else 10)
+            for n, name in enumerate(names)
+        }
+        pool = AdapterPool(names, FakeBackend(adapters, devs))
+        run(pool.scan([dev.address for dev in devs]))
+        start = perf_counter()
+        run(sync(pool, devs))
+        took = perf_counter() - start
+        print(f"adapters: {count}: {RINGS / took:.1f} rings/s")
+
+
+def v1frame(body):
+    body = body.ljust(15, b"\0")
+    return body + bytes([sum(body) % 256])
+
+
+def v1frames(opcode, payload, first):
+    chunks = [payload[i : i + 13] for i in range(0, len(payload), 13)]
+    return [v1frame(bytes([opcode, 0, len(chunks) + 1]) + first)] + [
+        v1frame(bytes([opcode, i + 1]) + chunk)
+        for i, chunk in enumerate(chunks)
+    ]
+
+
+def hrlog(ts):
+    # HRLog has the frame count in the payload of the first frame
+    hr = pack("<L", ts) + bytes(randrange(50, 120) for _ in range(288))
+    count = (len(hr) + 13 + 12) // 13
+    hr = bytes([count]) + bytes(12) + hr
+    return [
+        v1frame(bytes([0x15, i]) + hr[i * 13 : (i + 1) * 13])
+        for i in range(count)
+    ]
+
+
+def stresslog(ago):
+    return v1frames(
+        0x37,
+        bytes([ago]) + bytes(randrange(100) for _ in range(48)) + bytes(3),
+        bytes([30]),
+    )
+
+
+def actlog():
+    return [v1frame(bytes([0x43, 0xF0, 96, 1]))] + [
+        v1frame(
+            bytes([0x43, 0x23, 0x11, 0x14, i, i, 96])
+            + pack("<HHH", 10, randrange(1000), 500)
+        )
+        for i in range(96)
+    ]
+
+
+def v2frames(opcode, payload):
+    data = bytes([0xBC, opcode]) + pack("<H", len(payload)) + b"\0\0" + payload
+    return [data[i : i + 240] for i in range(0, len(data), 240)]
+
+
+def spo2log():
+    return v2frames(
+        0x2A,
+        b"".join(
+            bytes([d]) + bytes(randrange(90, 100) for _ in range(48))
+            for d in range(7)
+        ),
+    )
+
+
+def sleeplog():
+    return v2frames(
+        0x27,
+        bytes([7])
+        + b"".join(
+            bytes([d, 12])
+            + pack("<HH", 1380, 420)
+            + bytes([2, 60, 3, 120, 4, 90, 5, 10])
+            for d in range(7)
+        ),
+    )
+
+
+def transfers(day):
+    """Frames of a day worth of history, as a sync would receive them"""
+    return (
+        (HRLog, hrlog(BASE + (day + 1) * 86400)),
+        (StressLog, stresslog(0)),
+        (ActLog, actlog()),
+        (SPO2Log, spo2log()),
+    )
+
+
+class FakeService:
+    def __init__(self, proto):
+        self.uuid = proto.UART_SRV_UUID
+        self.characteristics = [
+            FakeCharacteristic(proto.UART_WRT_UUID),
+            FakeCharacteristic(proto.UART_NOT_UUID),
+        ]
+
+
+class FakeCharacteristic:
+    def __init__(self, uuid):
+        self.uuid = uuid
+
+
+class FakeRing:
+    """Client that answers requests as a ring would, with random history"""
+
+    def __init__(self, address):
+        self.address = address
+        self.services = [FakeService(Opv1), FakeService(Opv2)]
+        self.notify = {}
+
+    async def connect(self):
+        pass
+
+    async def disconnect(self):
+        pass
+
+    async def start_notify(self, uuid, callback):
+        self.notify[uuid] = callback
+
+    def respond(self, data):
+        if data[0] == 0xBC:
+            logs = {0x2A: spo2log, 0x27: sleeplog}
+            return Opv2.UART_NOT_UUID, logs[data[1]]()
+        op = data[0]
+        if op == 0x03:  # Battery
+            frames = [v1frame(bytes([op, 80, 0]))]
+        elif op == 0x16:  # HR log preference
+            frames = [v1frame(bytes([op, 1, 1, 5]))]
+        elif op in (0x2C, 0x36, 0x38):  # Other preferences
+            frames = [v1frame(bytes([op, 1, 1]))]
+        elif op == 0x15:
+            frames = hrlog(unpack("<L", data[1:5])[0])
+        elif op == 0x37:
+            frames = stresslog(data[1])
+        elif op == 0x43:
+            frames = actlog()
+        else:
+            frames = [v1frame(bytes([op]))]
+        return Opv1.UART_NOT_UUID, frames
+
+    async def write_gatt_char(self, uuid, data, response=False):
+        notuuid, frames = self.respond(bytes(data))
+        get_running_loop().create_task(self.send(notuuid, frames))
+
+    async def send(self, uuid, frames):
+        for frame in frames:
+            await sleep(0)
+            # Bleak hands every notification in a new bytearray
+            self.notify[uuid](None, bytearray(frame))
+
+
+class RingBackend(FakeBackend):
+    def client(self, dev, adapter):
+        return FakeRing(dev.address)
+
+
+def bench_sync():
+    """
+    Memory used by a first sync of 36 rings, a week of history each,
+    decoded, archived, stored and exported as a sync does it
+    """
+    tmpdir = mkdtemp()
+    store = Store(path.join(tmpdir, "store.db"))
+    exp = Exporter(SINKS["influx"](path.join(tmpdir, "influx")))
+    devs = [FakeDevice(ring(n)) for n in range(RINGS)]
+    pool = AdapterPool(["hci0"], RingBackend({}, devs))
+    sync = Sync(store, pool, exp)
+    seed(42)
+    with open(devnull, "w") as out, redirect_stdout(out):
+        trace()
+        start = perf_counter()
+        run(sync.run([dev.address for dev in devs]))
+        took = perf_counter() - start
+        current, peak = get_traced_memory()
+        untrace()
+    exp.close()
+    samples = store.db.execute("SELECT count(*) FROM samples").fetchone()[0]
+    print(
+        f"sync: {RINGS} rings, {samples} samples in {took:.1f}s,"
+        f" peak {peak / 1024:.0f} KiB, after {current / 1024:.0f} KiB"
+    )
+    store.close()
+
+
+def bench_export():
+    """Points per second exported when backfilling a year of 36 rings"""
+    seed(42)
+    ops = []
+    for cls, frames in transfers(0):
+        op = cls()
+        for frame in frames:
+            op.recv(None, frame)
+        ops.append(op)
+    tmpdir = mkdtemp()
+    for kind, sink in SINKS.items():
+        fname = path.join(tmpdir, kind)
+        # The OpenMetrics file is rewritten as a whole on every flush
+        exp = Exporter(
+            sink(fname), batch=100000 if kind == "openmetrics" else 1000
+        )
+        start = perf_counter()
+        for n in range(RINGS):
+            for _ in range(DAYS):
+                for op in ops:
+                    exp.add(ring(n), op, op.records())
+        exp.close()
+        took = perf_counter() - start
+        print(
+            f"export: {kind}: {exp.written} points,"
+            f" {exp.written / took:.0f} points/s"
+        )
+        unlink(fname)
+
+
+BENCHMARKS = {
+    name[6:]: fn for name, fn in globals().items() if name.startswith("bench_")
+}
+
+if __name__ == "__main__":
+    for name in argv[1:] or BENCHMARKS.keys():
+        BENCHMARKS[name]()